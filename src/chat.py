@@ -1,24 +1,37 @@
 import os
 import argparse
+from functools import lru_cache
 from dotenv import load_dotenv
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
-from src.utils import check_env_vars, v_print, get_chat_model
+from src.utils import check_env_vars, v_print, no_op, get_chat_model
 from src.search import DocumentSearcher
 
 
 
 
+def _source_info(source: str, page: str) -> str:
+    """Formata a identificação da fonte de um documento."""
+    return f"Fonte: {os.path.basename(source)}, Página: {page}"
+
+@lru_cache(maxsize=128)
+def _format_context_cached(doc_keys: tuple) -> str:
+    """Monta a string de contexto a partir das chaves (fonte, página, conteúdo) dos documentos."""
+    return "\n\n---\n\n".join(f"{content}\n({_source_info(source, page)})" for source, page, content in doc_keys)
+
 def format_context(docs_with_scores, verbose_print):
     """Formata os documentos recuperados em uma string de contexto."""
-    context = []
-    verbose_print("\n--- Documentos Recuperados ---")
-    for i, (doc, score) in enumerate(docs_with_scores):
-        source_info = f"Fonte: {os.path.basename(doc.metadata.get('source', 'N/A'))}, Página: {doc.metadata.get('page', 'N/A')}"
-        context.append(f"{doc.page_content}\n({source_info})")
-        verbose_print(f"Doc {i+1} (Score: {score:.4f}): {source_info}\n{doc.page_content[:100]}...")
-    verbose_print("--------------------------\n")
-    return "\n\n---\n\n".join(context)
+    doc_keys = tuple(
+        (str(doc.metadata.get('source', 'N/A')), str(doc.metadata.get('page', 'N/A')), doc.page_content)
+        for doc, _ in docs_with_scores
+    )
+    # Sem verbose, o laço de logs é pulado por completo
+    if verbose_print is not no_op:
+        verbose_print("\n--- Documentos Recuperados ---")
+        for i, ((source, page, content), (_, score)) in enumerate(zip(doc_keys, docs_with_scores)):
+            verbose_print(f"Doc {i+1} (Score: {score:.4f}): {_source_info(source, page)}\n{content[:100]}...")
+        verbose_print("--------------------------\n")
+    return _format_context_cached(doc_keys)
 
 def main():
     """
@@ -114,10 +127,7 @@ RESPONDA A "PERGUNTA DO USUÁRIO"
             # Se a estratégia for 'best', o usuário pediu para não mostrar os documentos recuperados no log,
             # apenas as estatísticas (que já são mostradas pelo searcher).
             # Então passamos uma função de print vazia para o format_context se strategy == 'best'.
-            context_printer = verbose_print
-            if args.strategy == 'best':
-                def no_op(*args, **kwargs): pass
-                context_printer = no_op
+            context_printer = no_op if args.strategy == 'best' else verbose_print
 
             context = format_context(relevant_docs, context_printer) if relevant_docs else ""
             
@@ -132,5 +142,7 @@ RESPONDA A "PERGUNTA DO USUÁRIO"
         except Exception as e:
             print(f"\nOcorreu um erro durante o chat: {e}")
 
+    searcher.close()
+
 if __name__ == '__main__':
     main()
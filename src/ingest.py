@@ -1,10 +1,58 @@
 import os
 import argparse
+import psycopg
 from dotenv import load_dotenv
 from langchain_community.document_loaders import PyPDFLoader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_postgres import PGVector
-from src.utils import get_connection_string, check_env_vars, get_embeddings_model, v_print
+from src.utils import get_connection_string, check_env_vars, get_embeddings_model, get_pgvector_version, v_print, hnsw_params
+
+# Índice HNSW sobre o embedding binarizado, usado no primeiro estágio da busca (pgvector >= 0.7).
+# A expressão precisa ser idêntica à usada nas consultas de `src.search`.
+BINARY_INDEX_SQL = """
+CREATE INDEX IF NOT EXISTS ix_langchain_pg_embedding_binary_{dim}
+ON langchain_pg_embedding
+USING hnsw ((binary_quantize(embedding)::bit({dim})) bit_hamming_ops)
+WITH (m = {m}, ef_construction = {ef_construction})
+"""
+
+# Índice HNSW sobre o embedding convertido para halfvec (float16), usado ao buscar os conjuntos de
+# candidatos (pgvector >= 0.7). É parcial por dimensão, pois a tabela é compartilhada por coleções de
+# modelos diferentes e a conversão para halfvec({dim}) falharia nas demais; as consultas repetem o filtro.
+HALFVEC_INDEX_SQL = """
+CREATE INDEX IF NOT EXISTS ix_langchain_pg_embedding_halfvec_{dim}
+ON langchain_pg_embedding
+USING hnsw ((embedding::halfvec({dim})) halfvec_cosine_ops)
+WITH (m = {m}, ef_construction = {ef_construction})
+WHERE vector_dims(embedding) = {dim}
+"""
+
+# Os índices cobrem a tabela inteira (todas as coleções), então é dimensionado pelo total de linhas
+EMBEDDING_COUNT_SQL = "SELECT COUNT(*) FROM langchain_pg_embedding"
+
+COLLECTION_DIMS_SQL = """
+SELECT vector_dims(e.embedding)
+FROM langchain_pg_embedding e
+JOIN langchain_pg_collection c ON e.collection_id = c.uuid
+WHERE c.name = %s
+LIMIT 1
+"""
+
+def create_quantized_indexes(collection_name: str, verbose_print):
+    """Cria os índices HNSW binário e halfvec para a dimensão dos embeddings da coleção, se suportado."""
+    with psycopg.connect(get_connection_string("postgresql"), autocommit=True) as conn:
+        if get_pgvector_version(conn) < (0, 7):
+            verbose_print("pgvector anterior à 0.7: índices quantizados não criados (a busca usará a distância exata).")
+            return
+        row = conn.execute(COLLECTION_DIMS_SQL, (collection_name,)).fetchone()
+        if row is None:
+            return
+        params = hnsw_params(conn.execute(EMBEDDING_COUNT_SQL).fetchone()[0])
+        verbose_print(f"Criando índice HNSW binário para embeddings de {row[0]} dimensões "
+                      f"(m={params['m']}, ef_construction={params['ef_construction']})...")
+        conn.execute(BINARY_INDEX_SQL.format(dim=row[0], **params))
+        verbose_print("Criando índice HNSW halfvec...")
+        conn.execute(HALFVEC_INDEX_SQL.format(dim=row[0], **params))
 
 def main():
     """
@@ -81,6 +129,11 @@ def main():
         pre_delete_collection=True,
     )
 
+    try:
+        create_quantized_indexes(collection_name, verbose_print)
+    except Exception as e:
+        print(f"Aviso: não foi possível criar os índices quantizados: {e}")
+
     print("\nProcesso de ingestão concluído com sucesso!")
 
 if __name__ == '__main__':
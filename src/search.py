@@ -1,283 +1,936 @@
-import os
+import io
+import re
+import asyncio
+import contextvars
+from functools import cached_property, lru_cache
+import numpy as np
+from psycopg_pool import ConnectionPool
+from pgvector.psycopg import register_vector
+from sqlalchemy import create_engine
+from sqlalchemy.pool import NullPool
 from dotenv import load_dotenv
 from langchain_postgres import PGVector
+from langchain_core.documents import Document
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.output_parsers import StrOutputParser
-from src.utils import get_connection_string, check_env_vars, get_embeddings_model, get_chat_model, v_print
+from langchain_core.output_parsers import StrOutputParser, JsonOutputParser
+from langchain_core.exceptions import OutputParserException
+from langchain_core.utils.json import parse_json_markdown
+from src.utils import get_connection_string, get_env, check_env_vars, get_embeddings_model, get_chat_model, get_pgvector_version, embeddings_provider, hash_key, LRUCache, SqliteCache, hnsw_params
 
+# Número de documentos usados para comparar as estratégias no modo 'best'
+BEST_PROBE_K = 3
+
+# Estratégias do modo 'best' em ordem crescente de custo; as de um mesmo grupo rodam em paralelo
+BEST_STRATEGY_TIERS = (('default',), ('query2doc', 'hyde'), ('iter-retgen',))
+
+# Distância média padrão abaixo da qual o modo 'best' não executa as estratégias mais caras
+# (sobrescrita pela variável de ambiente BEST_EARLY_EXIT)
+BEST_EARLY_EXIT_DEFAULT = 0.25
+
+# UUID da coleção, resolvido uma única vez por buscador
+COLLECTION_ID_SQL = "SELECT uuid FROM langchain_pg_collection WHERE name = %s"
+
+# Número de embeddings da tabela (que dimensiona o HNSW, compartilhado por todas as coleções,
+# como na ingestão) e da coleção, numa única varredura
+EMBEDDING_COUNTS_SQL = "SELECT COUNT(*), COUNT(*) FILTER (WHERE collection_id = %s) FROM langchain_pg_embedding"
+
+# Índices quantizados criados na ingestão (um por dimensão, veja `ingest.create_quantized_indexes`)
+QUANTIZED_INDEXES_SQL = """
+SELECT indexname FROM pg_indexes
+WHERE tablename = 'langchain_pg_embedding' AND indexname LIKE 'ix_langchain_pg_embedding_%'
+"""
+_QUANTIZED_INDEX_RE = re.compile(r"ix_langchain_pg_embedding_(binary|halfvec)_(\d+)")
+
+# Busca em dois estágios (pgvector >= 0.7): varredura ampla por distância de Hamming sobre o
+# embedding binarizado (índice HNSW de expressão criado na ingestão) e reordenação exata por
+# cosseno apenas dos candidatos. A dimensão precisa ser literal para casar com o índice.
+BINARY_KNN_SQL = """
+SELECT id, document, cmetadata, embedding <=> %(vector)s AS distance
+FROM (
+    SELECT id, document, cmetadata, embedding
+    FROM langchain_pg_embedding
+    WHERE collection_id = %(collection_id)s
+    ORDER BY binary_quantize(embedding)::bit({dim}) <~> binary_quantize(%(vector)s)
+    LIMIT %(candidates)s
+) c
+ORDER BY distance
+LIMIT %(k)s
+"""
+
+# Busca exata por cosseno, usada quando não há índice binário para a dimensão
+EXACT_KNN_SQL = """
+SELECT id, document, cmetadata, embedding <=> %(vector)s AS distance
+FROM langchain_pg_embedding
+WHERE collection_id = %(collection_id)s
+ORDER BY distance
+LIMIT %(k)s
+"""
+
+# Conjunto amplo de candidatos com seus embeddings (reordenado localmente em `CandidatePool`).
+# Com pgvector >= 0.7, a varredura usa o índice HNSW halfvec (float16, metade da banda de memória)
+# criado na ingestão; o filtro por dimensão casa com o predicado do índice parcial.
+HALFVEC_POOL_SQL = """
+SELECT id, document, cmetadata, embedding
+FROM langchain_pg_embedding
+WHERE collection_id = %(collection_id)s AND vector_dims(embedding) = {dim}
+ORDER BY embedding::halfvec({dim}) <=> %(vector)s::halfvec({dim})
+LIMIT %(k)s
+"""
+
+EXACT_POOL_SQL = """
+SELECT id, document, cmetadata, embedding
+FROM langchain_pg_embedding
+WHERE collection_id = %(collection_id)s
+ORDER BY embedding <=> %(vector)s
+LIMIT %(k)s
+"""
+
+# Quantos candidatos binários são reordenados por documento pedido
+BINARY_CANDIDATE_FACTOR = 10
+
+# Define o ef_search apenas na transação corrente (equivalente a SET LOCAL, mas parametrizável)
+SET_EF_SEARCH_SQL = "SELECT set_config('hnsw.ef_search', %s, true)"
+
+# Os índices HNSW quantizados cobrem todas as coleções da tabela e o filtro por coleção é aplicado
+# depois da varredura do índice. Com pgvector >= 0.8, a varredura iterativa continua até encontrar
+# linhas suficientes da coleção (a ordem relaxada é corrigida pela reordenação exata posterior).
+SET_ITERATIVE_SCAN_SQL = "SELECT set_config('hnsw.iterative_scan', 'relaxed_order', true)"
+
+# Faixa de valores aceita pelo pgvector para hnsw.ef_search
+HNSW_EF_SEARCH_MAX = 1000
+
+# Fator de ampliação do conjunto de candidatos reordenado localmente no ITER-RETGEN
+CANDIDATE_POOL_FACTOR = 4
+
+# Marcadores de lacuna usados pelo ITER-RETGEN; o grupo captura o tópico da lacuna
+_MISSING_RE = re.compile(r"\[MISSING:\s*([^\]]+)\]")
+
+# Limite de caracteres do contexto recuperado enviado ao LLM em cada iteração do ITER-RETGEN
+CONTEXT_MAX_CHARS = 4000
+
+# Limite de caracteres do complemento (rascunho, consultas) anexado à query no texto de busca;
+# a API de embeddings cobra por token e trunca entradas longas de qualquer forma
+SEARCH_TEXT_MAX_CHARS = 6000
+
+# Silencia os logs detalhados no contexto corrente (ex.: tarefas concorrentes do modo 'best'),
+# sem afetar outras buscas que usem o mesmo buscador
+_SILENT = contextvars.ContextVar("silent", default=False)
+
+# Cache de embeddings compartilhado entre instâncias, chaveado por (provedor, modelo, texto)
+_EMBEDDING_CACHE = LRUCache(maxsize=1024, ttl=3600)
+
+# Cache dos textos gerados por HyDE e Query2Doc, chaveado por (provedor, modelo, estratégia, query)
+_EXPANSION_CACHE = LRUCache(maxsize=256, ttl=3600)
+
+def _enable_persistent_cache(path: str):
+    """Persiste os caches de embeddings e de expansões no arquivo SQLite indicado (uma vez por processo)."""
+    # Cada cache tem a própria tabela, com o mesmo TTL da camada em memória
+    if _EMBEDDING_CACHE.backing is None:
+        _EMBEDDING_CACHE.backing = SqliteCache(path, "embeddings", _EMBEDDING_CACHE.ttl)
+        _EXPANSION_CACHE.backing = SqliteCache(path, "expansions", _EXPANSION_CACHE.ttl)
+
+@lru_cache(maxsize=None)
+def _shared_pool(conninfo: str) -> ConnectionPool:
+    """
+    Pool de conexões psycopg para as consultas SQL próprias, com o tipo `vector` registrado.
+    Compartilhado por todos os buscadores do processo, evitando novas conexões a cada instância.
+    """
+    pool = ConnectionPool(
+        conninfo,
+        min_size=1,
+        max_size=8,
+        kwargs={"autocommit": True},
+        configure=register_vector,
+        check=ConnectionPool.check_connection,
+        open=True,
+    )
+    try:
+        pool.wait()
+    except Exception:
+        # Banco indisponível: não deixa o pool tentando reconectar em segundo plano
+        pool.close()
+        raise
+    return pool
+
+# Prompts usados na geração dos textos de busca
+HYDE_PROMPT = """Escreva um parágrafo conciso que responda de forma clara à pergunta abaixo. 
+A resposta deve parecer um documento real, com datas, fatos ou descrições prováveis, 
+mesmo que hipotéticas. 
+Não use linguagem especulativa (não diga "talvez" ou "possivelmente").
+Pergunta: {query}
+Texto: """
+
+QUERY2DOC_PROMPT = """Escreva um texto informativo e neutro, de 100 a 150 palavras, que explique o tópico abaixo. 
+Inclua definições, termos técnicos, sinônimos e contexto relacionado, mas não dê uma resposta direta 
+se for uma pergunta.
+Tópico: {query}
+Texto: """
+
+# HyDE e Query2Doc numa única chamada, usada quando o modo 'best' precisa dos dois textos
+EXPANSIONS_PROMPT = """Para a pergunta abaixo, escreva dois textos:
+- "hyde": um parágrafo conciso que responda de forma clara à pergunta. A resposta deve parecer um
+  documento real, com datas, fatos ou descrições prováveis, mesmo que hipotéticas. Não use linguagem
+  especulativa (não diga "talvez" ou "possivelmente").
+- "query2doc": um texto informativo e neutro, de 100 a 150 palavras, que explique o tópico. Inclua
+  definições, termos técnicos, sinônimos e contexto relacionado, mas não dê uma resposta direta.
+Pergunta: {query}
+Retorne APENAS um objeto JSON com as chaves "hyde" e "query2doc"."""
+
+ITER_DRAFT_PROMPT = """You are an expert assistant with limited initial knowledge.
+Answer the following question, but you MUST mark MANY specific details as missing.
+Use [MISSING: ...] markers for:
+- Specific version numbers and release dates
+- Technical specifications and parameters
+- Performance metrics and benchmarks
+- Comparison data between different versions
+- Implementation details and code examples
+- Real-world use cases and case studies
+- Limitations and known issues
+- Future roadmap and upcoming features
+
+Be thorough in identifying what specific information would make the answer complete.
+Start with a basic overview but mark MANY specific details as missing.
+
+Do not generate more than 5 MISSING Markers.
+For each [MISSING: ...] marker, also write a short search query with the information
+that would fill that gap.
+Question: {query}
+
+Return ONLY a JSON object with the keys, in this order:
+- "gap_queries": list of strings, one search query per [MISSING: ...] marker
+- "refined_draft": string with the answer containing the [MISSING: ...] markers"""
+
+ITER_FILL_PROMPT = """Original question: {query}
+
+Current draft (iteration {iteration}):
+{draft}
+
+Information to help fill the gaps:
+{context}
+
+CRITICAL INSTRUCTIONS:
+1. You MUST replace AT LEAST 1-2 [MISSING: ...] markers with concrete information
+2. ACTUALLY REPLACE the text '[MISSING: xyz]' with real content - don't keep the marker
+3. Use the information above to guide what content to add
+4. Do NOT add any new [MISSING:] markers - only fill or keep existing ones
+5. If you cannot fill a gap with certainty, keep it as [MISSING: ...]
+
+Important: This is iteration {iteration}. You MUST make progress by filling gaps.
+
+Return ONLY a JSON object with the keys, in this order:
+- "gap_queries": list of strings, one search query for each [MISSING: ...] marker still left
+- "refined_draft": string with the ENTIRE answer rewritten with the [MISSING:] markers replaced"""
+
+ITER_EXPANSION_PROMPT = """Review this draft answer:
+{draft}
+
+Identify areas that could benefit from MORE specific information.
+Add new [MISSING: ...] markers for:
+- Technical details that were glossed over
+- Specific examples that would clarify concepts
+- Comparative data that would add context
+- Implementation specifics that developers would need
+
+If the answer is already comprehensive, do not add any markers.
+
+Return ONLY a JSON object with the keys, in this order:
+- "gap_queries": list of strings, one search query per new [MISSING: ...] marker
+- "refined_draft": string with the same text plus the ADDITIONAL [MISSING: ...] markers"""
+
+def _join_with_budget(parts, max_chars: int, sep: str = "\n\n") -> str:
+    """
+    Concatena os textos com o separador, parando assim que `max_chars` é atingido.
+    O último texto é truncado para caber no limite; os restantes nem são consumidos.
+    """
+    buffer = io.StringIO()
+    remaining = max_chars
+    for part in parts:
+        if buffer.tell():
+            if remaining <= len(sep):
+                break
+            buffer.write(sep)
+            remaining -= len(sep)
+        buffer.write(part[:remaining])
+        remaining -= min(len(part), remaining)
+        if remaining <= 0:
+            break
+    return buffer.getvalue()
+
+def _search_text(query: str, *parts: str, max_chars: int = SEARCH_TEXT_MAX_CHARS) -> str:
+    """Monta o texto de busca: a query completa seguida dos complementos, limitados a `max_chars`."""
+    suffix = _join_with_budget((p for p in parts if p), max_chars, sep=" ")
+    return f"{query} {suffix}" if suffix else query
+
+def _missing_topics(draft: str) -> list[str]:
+    """Retorna os tópicos dos marcadores [MISSING: ...] do rascunho, em uma única varredura."""
+    return [m.group(1).strip() for m in _MISSING_RE.finditer(draft)]
+
+def _gap_queries(result: dict) -> list[str]:
+    """Extrai a lista de consultas de lacunas de uma resposta (possivelmente parcial) do LLM."""
+    return [str(q) for q in result.get("gap_queries") or []]
+
+# Estratégias cujo texto de busca depende apenas da query, e cujo vetor pode ser persistido
+PERSISTED_STRATEGIES = ('hyde', 'query2doc')
+
+# Tabela opcional com os vetores de HyDE e Query2Doc já calculados, compartilhada entre processos.
+# A coluna `vec` não fixa a dimensão, pois a tabela atende coleções de modelos diferentes.
+EXPANSION_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS query_expansion_cache (
+    key TEXT PRIMARY KEY,
+    strategy TEXT NOT NULL,
+    vec vector NOT NULL,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+)
+"""
+
+# Validade dos vetores persistidos, em segundos: linhas mais antigas são ignoradas e regravadas
+EXPANSION_VECTOR_TTL = 30 * 24 * 3600
+
+EXPANSION_GET_SQL = """
+SELECT key, vec FROM query_expansion_cache
+WHERE key = ANY(%s) AND created_at > now() - make_interval(secs => %s)
+"""
+
+EXPANSION_PUT_SQL = """
+INSERT INTO query_expansion_cache (key, strategy, vec) VALUES (%s, %s, %s)
+ON CONFLICT (key) DO UPDATE SET strategy = EXCLUDED.strategy, vec = EXCLUDED.vec, created_at = now()
+"""
+
+EXPANSION_PURGE_SQL = "DELETE FROM query_expansion_cache WHERE created_at < now() - make_interval(secs => %s)"
+
+def _check_ef_search(ef_search: int | None):
+    """Rejeita um ef_search explícito fora da faixa aceita pelo pgvector (1 a `HNSW_EF_SEARCH_MAX`)."""
+    if ef_search is not None and not 1 <= ef_search <= HNSW_EF_SEARCH_MAX:
+        raise ValueError(f"ef_search deve estar entre 1 e {HNSW_EF_SEARCH_MAX} (recebido: {ef_search}).")
+
+class ExpansionVectorStore:
+    """
+    Vetores de expansão da query (HyDE, Query2Doc) persistidos no Postgres: um acerto dispensa
+    tanto a chamada ao LLM quanto a de embeddings. Vetores com mais de `ttl` segundos são ignorados,
+    e removidos ao abrir a tabela.
+    """
+    def __init__(self, pool: ConnectionPool, ttl: float = EXPANSION_VECTOR_TTL):
+        self.pool = pool
+        self.ttl = ttl
+        with pool.connection() as conn:
+            conn.execute(EXPANSION_TABLE_SQL)
+            conn.execute(EXPANSION_PURGE_SQL, (ttl,))
+
+    def get_many(self, keys: list[str]) -> dict:
+        """Retorna os vetores válidos encontrados, por chave, numa única consulta."""
+        with self.pool.connection() as conn:
+            return dict(conn.execute(EXPANSION_GET_SQL, (keys, self.ttl), prepare=True).fetchall())
+
+    def put_many(self, items: list[tuple[str, str, list[float]]]):
+        """Grava os itens (chave, estratégia, vetor), substituindo os de chaves já existentes."""
+        with self.pool.connection() as conn, conn.cursor() as cur:
+            cur.executemany(EXPANSION_PUT_SQL, [(key, strategy, np.asarray(vec, dtype=np.float32)) for key, strategy, vec in items])
+
+class CandidatePool:
+    """
+    Conjunto de documentos candidatos com seus embeddings normalizados, permitindo
+    reordená-los localmente por distância de cosseno sem nova consulta ao banco.
+    """
+    def __init__(self, docs: list[Document], embeddings: list):
+        self.docs = docs
+        # Coleção vazia: matriz 0x0, já que a dimensão não pode ser inferida
+        matrix = np.asarray(embeddings, dtype=np.float32).reshape(len(docs), -1) if docs else np.empty((0, 0), dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        self.matrix = matrix / np.where(norms == 0, 1, norms)
+
+    def _nearest(self, vector: list[float], k: int) -> tuple[np.ndarray, np.ndarray]:
+        """Índices e distâncias de cosseno dos `k` candidatos mais próximos, em ordem crescente."""
+        if not self.docs:
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.float32)
+        query = np.asarray(vector, dtype=np.float32)
+        distances = 1.0 - self.matrix @ (query / (np.linalg.norm(query) or 1.0))
+        k = min(k, len(self.docs))
+        top = np.argpartition(distances, k - 1)[:k]
+        top = top[np.argsort(distances[top])]
+        return top, distances[top]
+
+    def rerank(self, vector: list[float], k: int) -> list[tuple[Document, float]]:
+        """Retorna os `k` candidatos mais próximos do vetor, com a distância de cosseno."""
+        top, distances = self._nearest(vector, k)
+        return [(self.docs[i], float(d)) for i, d in zip(top, distances)]
+
+    def distance_stats(self, vector: list[float], k: int) -> tuple[float, float, float] | None:
+        """(média, mínimo, mediana) das distâncias dos `k` candidatos mais próximos, ou None se vazio."""
+        # As distâncias já chegam ordenadas: o mínimo é a primeira e a mediana sai sem nova ordenação
+        _, distances = self._nearest(vector, k)
+        if not distances.size:
+            return None
+        mid = distances.size // 2
+        median = distances[mid] if distances.size % 2 else (distances[mid - 1] + distances[mid]) / 2
+        return float(distances.mean()), float(distances[0]), float(median)
 
 class DocumentSearcher:
     """
     Uma classe para encapsular a lógica de busca de documentos em um vector store.
+
+    Código assíncrono deve usar `asearch_documents`; `search_documents` roda em um loop próprio,
+    liberado por `close` (ou ao sair de um bloco `with`).
     """
     def __init__(self, provider: str, collection_name: str = "documentos_pdf", verbose: bool = False):
         """
         Inicializa o buscador, configurando embeddings e a conexão com o banco.
         """
-        self.verbose_print = v_print(verbose)
+        self.verbose = verbose
         self.verbose_print(f"Inicializando o buscador de documentos com o provedor: {provider}...")
         check_env_vars(provider)
         
+        self.provider = provider
         self.embeddings = get_embeddings_model(provider, verbose)
+        self.embeddings_provider = embeddings_provider(provider)
+        self._embeddings_model = getattr(self.embeddings, "model", None) or getattr(self.embeddings, "model_name", "")
         self.connection_string = get_connection_string()
         self.collection_name = collection_name
-        
-        # Inicializa o LLM para geração de texto (usado em HyDE e Query2Doc)
-        self.llm = get_chat_model(provider, verbose)
+        # Loop usado por `search_documents`, criado na primeira chamada e encerrado em `close`
+        self._loop = None
+        self.early_exit_threshold = float(get_env("BEST_EARLY_EXIT", BEST_EARLY_EXIT_DEFAULT))
+        if cache_path := get_env("SEARCH_CACHE_PATH"):
+            _enable_persistent_cache(cache_path)
+        self.expansion_store = None
+        # O LLM (usado em HyDE, Query2Doc e ITER-RETGEN) só é criado no primeiro uso; veja `llm`
 
         try:
-            self.db = PGVector(
+            # O PGVector só prepara o banco (extensão, tabelas e a coleção, criada se não existir);
+            # as buscas usam o pool psycopg abaixo, então a engine não mantém conexões abertas
+            PGVector(
                 embeddings=self.embeddings,
                 collection_name=self.collection_name,
-                connection=self.connection_string,
+                connection=create_engine(self.connection_string, poolclass=NullPool),
             )
+            self.pool = _shared_pool(get_connection_string("postgresql"))
+            with self.pool.connection() as conn:
+                self.iterative_scan = get_pgvector_version(conn) >= (0, 8)
+                # Dimensões com índice binário / halfvec (pgvector >= 0.7, criados na ingestão);
+                # sem o índice da dimensão, as buscas usam a varredura exata
+                self.quantized_index_dims = {"binary": set(), "halfvec": set()}
+                for (name,) in conn.execute(QUANTIZED_INDEXES_SQL):
+                    if match := _QUANTIZED_INDEX_RE.fullmatch(name):
+                        self.quantized_index_dims[match[1]].add(int(match[2]))
+                # A coleção não muda durante a sessão; as consultas filtram direto pelo UUID
+                self._collection_id = conn.execute(COLLECTION_ID_SQL, (self.collection_name,)).fetchone()[0]
+            if get_env("PERSIST_EXPANSION_VECTORS", "").lower() in ("1", "true"):
+                self.expansion_store = ExpansionVectorStore(self.pool)
+            self._tune_hnsw()
             self.verbose_print("Conexão com o banco de dados vetorial estabelecida com sucesso.")
         except Exception as e:
             raise ConnectionError(f"Não foi possível conectar ao banco de dados: {e}") from e
 
-    def _generate_text(self, prompt_template: str, input_vars: dict) -> str:
-        """Gera texto usando o LLM configurado."""
-        prompt = ChatPromptTemplate.from_template(prompt_template)
-        chain = prompt | self.llm | StrOutputParser()
-        return chain.invoke(input_vars)
+    def verbose_print(self, message: str, *args):
+        """
+        Imprime apenas em modo verbose e fora de um contexto silenciado. Os `args` são aplicados
+        a `message` no estilo printf (ex.: "%.200s") só quando a mensagem é de fato impressa.
+        """
+        if self.verbose and not _SILENT.get():
+            print(message % args if args else message)
+
+    def _tune_hnsw(self):
+        """
+        Escolhe os parâmetros do HNSW (`hnsw_params`) pelo total de embeddings da tabela: os índices
+        cobrem todas as coleções, e a ingestão os dimensiona pela mesma contagem.
+        """
+        with self.pool.connection() as conn:
+            total, count = conn.execute(EMBEDDING_COUNTS_SQL, (self._collection_id,)).fetchone()
+        self.collection_size = count
+        self.hnsw_params = hnsw_params(total)
+        self.verbose_print(f"Coleção com {count} de {total} embeddings: ef_search base {self.hnsw_params['ef_search']}.")
+
+    @cached_property
+    def llm(self):
+        """Modelo de chat usado na geração dos textos de busca, instanciado no primeiro acesso."""
+        return get_chat_model(self.provider, self.verbose)
+
+    @cached_property
+    def _chains(self) -> dict:
+        """
+        Chains pré-compiladas (prompt | LLM | parser) de cada prompt usado nas estratégias,
+        evitando reconstruí-las a cada chamada.
+        """
+        # As etapas do ITER-RETGEN devolvem o texto bruto: o JSON é interpretado em
+        # `_agenerate_draft_step`, que precisa do texto original caso ele não seja JSON.
+        text_prompts = {'hyde': HYDE_PROMPT, 'query2doc': QUERY2DOC_PROMPT, 'iter_draft': ITER_DRAFT_PROMPT, 'iter_fill': ITER_FILL_PROMPT, 'iter_expand': ITER_EXPANSION_PROMPT}
+        chains = {key: ChatPromptTemplate.from_template(t) | self.llm | StrOutputParser() for key, t in text_prompts.items()}
+        chains['expansions'] = ChatPromptTemplate.from_template(EXPANSIONS_PROMPT) | self.llm | JsonOutputParser()
+        return chains
+
+    def _embedding_key(self, text: str) -> str:
+        """Chave do cache de embeddings para o texto (provedor, modelo, texto)."""
+        return hash_key(self.embeddings_provider, self._embeddings_model, text)
+
+    async def _acached_embed(self, text: str) -> list[float]:
+        """Retorna o embedding do texto, consultando o cache antes de chamar a API."""
+        key = self._embedding_key(text)
+        vector = _EMBEDDING_CACHE.get(key)
+        if vector is None:
+            vector = await self.embeddings.aembed_query(text)
+            _EMBEDDING_CACHE.put(key, vector)
+        return vector
+
+    async def _acached_embed_many(self, texts: list[str]) -> list[list[float]]:
+        """
+        Retorna os embeddings de vários textos de consulta, enviando os que não estão
+        em cache à API numa única requisição em lote.
+        """
+        keys = [self._embedding_key(text) for text in texts]
+        vectors = {key: _EMBEDDING_CACHE.get(key) for key in keys}
+        missing = {key: text for key, text in zip(keys, texts) if vectors[key] is None}
+
+        if missing:
+            # O Google diferencia embeddings de consulta e de documento; o lote deve usar o tipo de consulta
+            kwargs = {"task_type": "RETRIEVAL_QUERY"} if self.embeddings_provider == 'google' else {}
+            new_vectors = await self.embeddings.aembed_documents(list(missing.values()), **kwargs)
+            for key, vector in zip(missing, new_vectors):
+                vectors[key] = vector
+                _EMBEDDING_CACHE.put(key, vector)
+
+        return [vectors[key] for key in keys]
+
+    def _search_by_vector(self, vector: list[float], k: int, ef_search: int | None = None) -> list[tuple[Document, float]]:
+        """
+        Busca os `k` documentos mais próximos do vetor. Com o índice binário da dimensão,
+        usa a busca em dois estágios (Hamming + reordenação por cosseno).
+        `ef_search` ajusta a troca entre latência e recall do HNSW (veja `_execute_knn`).
+        """
+        vector = np.asarray(vector, dtype=np.float32)
+        params = {"vector": vector, "collection_id": self._collection_id, "k": k}
+        if len(vector) in self.quantized_index_dims["binary"]:
+            sql = BINARY_KNN_SQL.format(dim=len(vector))
+            params["candidates"] = index_limit = k * BINARY_CANDIDATE_FACTOR
+        else:
+            sql = EXACT_KNN_SQL
+            index_limit = k
+        rows = self._execute_quantized_knn(sql, EXACT_KNN_SQL, params, index_limit, k, ef_search)
+        return [
+            (Document(id=str(doc_id), page_content=document, metadata=cmetadata or {}), float(distance))
+            for doc_id, document, cmetadata, distance in rows
+        ]
+
+    def _execute_knn(self, sql: str, params: dict, index_limit: int, ef_search: int | None = None) -> list:
+        """
+        Executa uma consulta KNN com o hnsw.ef_search ajustado só para ela. Por padrão, usa o valor
+        escolhido pelo tamanho da tabela de embeddings, e pelo menos o dobro das linhas pedidas ao índice
+        (que devolve no máximo ef_search linhas), limitado a `HNSW_EF_SEARCH_MAX`.
+        """
+        _check_ef_search(ef_search)
+        if ef_search is None:
+            ef_search = min(max(self.hnsw_params["ef_search"], 2 * index_limit), HNSW_EF_SEARCH_MAX)
+        with self.pool.connection() as conn, conn.transaction():
+            conn.execute(SET_EF_SEARCH_SQL, (str(ef_search),), prepare=True)
+            if self.iterative_scan:
+                conn.execute(SET_ITERATIVE_SCAN_SQL, prepare=True)
+            return conn.execute(sql, params, prepare=True).fetchall()
+
+    def _execute_quantized_knn(self, sql: str, exact_sql: str, params: dict, index_limit: int, k: int, ef_search: int | None = None) -> list:
+        """
+        Executa `sql` (que usa um índice quantizado, se disponível) e, se vierem menos de `k` linhas
+        numa coleção que tem mais documentos, repete a busca com a varredura exata `exact_sql`:
+        o índice compartilhado pode ter esgotado o ef_search com documentos de outras coleções.
+        """
+        rows = self._execute_knn(sql, params, index_limit, ef_search)
+        if sql is not exact_sql and len(rows) < min(k, self.collection_size):
+            self.verbose_print("Índice quantizado devolveu documentos insuficientes; usando a busca exata.")
+            rows = self._execute_knn(exact_sql, params, k, ef_search)
+        return rows
+
+    async def _asearch_by_vector(self, vector: list[float], k: int, ef_search: int | None = None):
+        """Busca por similaridade a partir de um embedding já calculado."""
+        # O psycopg opera em modo síncrono; a consulta roda em uma thread para não bloquear o loop
+        return await asyncio.to_thread(self._search_by_vector, vector, k, ef_search)
+
+    def _fetch_candidate_pool(self, vector: list[float], size: int, ef_search: int | None = None) -> "CandidatePool":
+        """Busca os `size` documentos mais próximos do vetor, junto com seus embeddings."""
+        vector = np.asarray(vector, dtype=np.float32)
+        params = {"vector": vector, "collection_id": self._collection_id, "k": size}
+        sql = HALFVEC_POOL_SQL.format(dim=len(vector)) if len(vector) in self.quantized_index_dims["halfvec"] else EXACT_POOL_SQL
+        rows = self._execute_quantized_knn(sql, EXACT_POOL_SQL, params, size, size, ef_search)
+        docs = [
+            Document(id=str(doc_id), page_content=document, metadata=cmetadata or {})
+            for doc_id, document, cmetadata, _ in rows
+        ]
+        return CandidatePool(docs, [embedding for *_, embedding in rows])
+
+    async def _afetch_candidate_pool(self, vector: list[float], size: int, ef_search: int | None = None) -> "CandidatePool":
+        """Versão assíncrona de `_fetch_candidate_pool`."""
+        return await asyncio.to_thread(self._fetch_candidate_pool, vector, size, ef_search)
 
-    def _generate_hyde_doc(self, query: str) -> str:
+    def _expansion_vector_key(self, strategy: str, query: str) -> str:
+        """Chave do vetor persistido de uma estratégia: a chave da expansão mais o modelo de embeddings."""
+        return hash_key(self._expansion_key(strategy, query), self._embeddings_model)
+
+    async def _aload_expansion_vectors(self, query: str, strategies) -> dict:
+        """Vetores já persistidos das estratégias (apenas as de `PERSISTED_STRATEGIES`), por estratégia."""
+        keys = {s: self._expansion_vector_key(s, query) for s in strategies if s in PERSISTED_STRATEGIES}
+        if self.expansion_store is None or not keys:
+            return {}
+        found = await asyncio.to_thread(self.expansion_store.get_many, list(keys.values()))
+        return {s: found[key] for s, key in keys.items() if key in found}
+
+    async def _asave_expansion_vectors(self, query: str, vectors: dict):
+        """Persiste os vetores recém-calculados das estratégias de `PERSISTED_STRATEGIES`."""
+        items = [(self._expansion_vector_key(s, query), s, v) for s, v in vectors.items() if s in PERSISTED_STRATEGIES]
+        if self.expansion_store is not None and items:
+            await asyncio.to_thread(self.expansion_store.put_many, items)
+
+    def _expansion_key(self, chain_key: str, query: str) -> str:
+        """Chave do cache de expansões (provedor, modelo, estratégia, query)."""
+        model = getattr(self.llm, "model", None) or getattr(self.llm, "model_name", "")
+        return hash_key(self.provider, model, chain_key, query)
+
+    async def _acached_expansion(self, chain_key: str, query: str) -> str:
+        """Gera o texto de expansão da query, reaproveitando o resultado de perguntas repetidas."""
+        key = self._expansion_key(chain_key, query)
+        text = _EXPANSION_CACHE.get(key)
+        if text is None:
+            text = await self._chains[chain_key].ainvoke({"query": query})
+            _EXPANSION_CACHE.put(key, text)
+        else:
+            self.verbose_print("Texto recuperado do cache.")
+        return text
+
+    async def _aprefetch_expansions(self, query: str):
+        """
+        Gera os textos de HyDE e Query2Doc numa única chamada ao LLM e os guarda no cache de
+        expansões, onde `_acached_expansion` os encontra. Não faz nada se ambos já estiverem em cache.
+        """
+        keys = {chain_key: self._expansion_key(chain_key, query) for chain_key in ('hyde', 'query2doc')}
+        if all(_EXPANSION_CACHE.get(key) is not None for key in keys.values()):
+            return
+        result = await self._chains['expansions'].ainvoke({"query": query})
+        for chain_key, key in keys.items():
+            if isinstance(result, dict) and result.get(chain_key):
+                _EXPANSION_CACHE.put(key, str(result[chain_key]))
+
+    async def _agenerate_draft_step(self, chain_key: str, input_vars: dict, retrieve=None) -> dict:
+        """
+        Executa uma etapa do ITER-RETGEN, retornando o rascunho refinado e as consultas das lacunas.
+
+        A resposta é consumida em streaming. Se `retrieve` (função assíncrona que recebe as
+        consultas das lacunas) for informada, a busca é disparada assim que as consultas chegam
+        completas, em paralelo à geração do restante do rascunho, e fica disponível em `retrieval`.
+
+        Se o LLM não responder em JSON, o texto bruto é usado como rascunho (e as lacunas vêm dos
+        marcadores [MISSING: ...]); um JSON malformado levanta `OutputParserException`.
+        """
+        chain = self._chains[chain_key]
+        raw = ""
+        result = {}
+        retrieval = None
+
+        def start_retrieval(gap_queries: list[str]):
+            self.verbose_print("Consultas para lacunas (Busca):\n%s", gap_queries)
+            return asyncio.create_task(retrieve(gap_queries))
+
+        try:
+            async for chunk in chain.astream(input_vars):
+                raw += chunk
+                try:
+                    partial = parse_json_markdown(raw)
+                except ValueError:
+                    continue
+                if not isinstance(partial, dict):
+                    continue
+                result = partial
+                # O prompt pede "gap_queries" antes de "refined_draft": quando o rascunho começa
+                # a chegar, a lista de consultas já está completa.
+                if retrieve is not None and retrieval is None and "refined_draft" in partial:
+                    retrieval = start_retrieval(_gap_queries(partial))
+
+            if result:
+                # A interpretação parcial descarta o trecho que não consegue ler (ex.: um escape
+                # inválido), o que truncaria o rascunho sem aviso: o texto completo precisa ser válido.
+                try:
+                    result = parse_json_markdown(raw)
+                except ValueError as e:
+                    print(f"⚠️ Resposta do LLM em JSON inválido na etapa '{chain_key}': {e}")
+                    raise OutputParserException(f"JSON inválido na etapa '{chain_key}': {e}", llm_output=raw) from e
+        except Exception:
+            if retrieval is not None:
+                retrieval.cancel()
+            raise
+
+        if isinstance(result, dict) and "refined_draft" in result:
+            gap_queries = _gap_queries(result)
+            refined_draft = str(result["refined_draft"])
+        else:
+            print(f"⚠️ Resposta do LLM sem 'refined_draft' na etapa '{chain_key}'; usando o texto bruto como rascunho.")
+            gap_queries = _missing_topics(raw)
+            refined_draft = raw.strip()
+
+        if retrieve is not None and retrieval is None:
+            retrieval = start_retrieval(gap_queries)
+
+        return {
+            "gap_queries": gap_queries,
+            "refined_draft": refined_draft,
+            "retrieval": retrieval,
+        }
+
+    async def _agenerate_hyde_doc(self, query: str) -> str:
         """Gera um documento hipotético para a query (HyDE)."""
-        prompt = """Escreva um parágrafo conciso que responda de forma clara à pergunta abaixo. 
-        A resposta deve parecer um documento real, com datas, fatos ou descrições prováveis, 
-        mesmo que hipotéticas. 
-        Não use linguagem especulativa (não diga "talvez" ou "possivelmente").
-        Pergunta: {query}
-        Texto: """
         self.verbose_print("Gerando documento hipotético (HyDE)...")
-        hyde_doc = self._generate_text(prompt, {"query": query})
-        self.verbose_print(f"Documento Hipotético gerado:\n{hyde_doc[:200]}...")
+        hyde_doc = await self._acached_expansion('hyde', query)
+        self.verbose_print("Documento Hipotético gerado:\n%.200s...", hyde_doc)
         return hyde_doc
 
-    def _generate_query2doc_expansion(self, query: str) -> str:
+    async def _agenerate_query2doc_expansion(self, query: str) -> str:
         """Expande a query com uma resposta gerada (Query2Doc)."""
-        prompt = """Escreva um texto informativo e neutro, de 100 a 150 palavras, que explique o tópico abaixo. 
-        Inclua definições, termos técnicos, sinônimos e contexto relacionado, mas não dê uma resposta direta 
-        se for uma pergunta.
-        Tópico: {query}
-        Texto: """
         self.verbose_print("Gerando expansão da query (Query2Doc)...")
-        answer = self._generate_text(prompt, {"query": query})
-        expanded_query = f"{query} {answer}"
-        self.verbose_print(f"Query expandida:\n{expanded_query[:200]}...")
+        answer = await self._acached_expansion('query2doc', query)
+        expanded_query = _search_text(query, answer)
+        self.verbose_print("Query expandida:\n%.200s...", expanded_query)
         return expanded_query
 
 
-    def _generate_iter_retgen_context(self, query: str, k: int) -> str:
+    async def _agenerate_iter_retgen_context(self, query: str, k: int, ef_search: int | None = None) -> str:
         """
         Executa o processo ITER-RETGEN (Iterative Retrieval-Generation) com placeholders [MISSING].
+        Cada etapa é uma única chamada ao LLM que devolve, em JSON, o rascunho refinado e as
+        consultas de busca para as lacunas restantes.
         """
         self.verbose_print("Iniciando estratégia ITER-RETGEN com refinamento de lacunas...")
         print("⚠️  Atenção: A estratégia ITER-RETGEN é detalhada e pode levar alguns minutos. Por favor, aguarde...")
+
+        # A primeira recuperação busca um conjunto amplo de candidatos no banco; as seguintes
+        # apenas reordenam esse conjunto localmente pela distância ao novo embedding.
+        pool = None
+
+        async def retrieve(gap_queries: list[str]):
+            nonlocal pool
+            # Usa as consultas geradas (hipotéticas) + query original para buscar documentos reais
+            vector = await self._acached_embed(_search_text(query, *gap_queries))
+            if pool is None:
+                pool = await self._afetch_candidate_pool(vector, k * CANDIDATE_POOL_FACTOR, ef_search)
+            return pool.rerank(vector, k)
         
         # 1. Draft Inicial com [MISSING]
-        draft_prompt = """You are an expert assistant with limited initial knowledge.
-        Answer the following question, but you MUST mark MANY specific details as missing.
-        Use [MISSING: ...] markers for:
-        - Specific version numbers and release dates
-        - Technical specifications and parameters
-        - Performance metrics and benchmarks
-        - Comparison data between different versions
-        - Implementation details and code examples
-        - Real-world use cases and case studies
-        - Limitations and known issues
-        - Future roadmap and upcoming features
-        
-        Be thorough in identifying what specific information would make the answer complete.
-        Start with a basic overview but mark MANY specific details as missing.
-        
-        Do not generate more than 5 MISSING Markers.
-        Question: {query}
-        
-        Answer:"""
-        
         self.verbose_print("Gerando draft inicial...")
-        current_draft = self._generate_text(draft_prompt, {"query": query})
-        self.verbose_print(f"Draft Inicial:\n{current_draft[:200]}...")
-
-        search_query_text = query # Fallback inicial
+        result = await self._agenerate_draft_step('iter_draft', {"query": query}, retrieve=retrieve)
+        current_draft, retrieval = result["refined_draft"], result["retrieval"]
+        self.verbose_print("Draft Inicial:\n%.200s...", current_draft)
         
         # 2. Ciclo de Refinamento (2 iterações para não estender demais, user pediu similar ao curso)
+        # Cada iteração: busca com as consultas das lacunas + uma única chamada que preenche e
+        # identifica as próximas lacunas.
         for i in range(2):
-            self.verbose_print(f"--- Iteração {i+1}/2 ---")
-            
-            # Identifica lacunas e gera hipóteses/queries para busca
-            query_prompt = """You received the following draft with gaps:
-            {draft}
-            
-            For each [MISSING: ...] marker, provide information to fill that gap.
-            Format each as: 'For [MISSING: topic]: provide the actual information'
-            Be specific and provide real data when possible.
-            Example: 'For [MISSING: version numbers]: LangChain is at version 0.1.0, LangGraph at 0.2.0'
-            List information for each gap, maximum 5 items."""
-            
-            gap_info = self._generate_text(query_prompt, {"draft": current_draft})
-            self.verbose_print(f"Informação para lacunas (Busca):\n{gap_info[:150]}...")
-            
-            # Recuperação (Retrieval)
-            # Usa a informação gerada (hipotética) + query original para buscar documentos reais
-            search_query_text = f"{query} {gap_info}"
-            docs = self.db.similarity_search_with_score(search_query_text, k=k)
-            retrieved_context = "\n\n".join([d.page_content for d, _ in docs])
-            
-            # Refinamento (Fill Gaps)
-            fill_prompt = """Original question: {query}
-            
-            Current draft (iteration {iteration}):
-            {draft}
+            self.verbose_print("--- Iteração %d/2 ---", i + 1)
             
-            Information to help fill the gaps:
-            {context}
+            # Recuperação (Retrieval), iniciada durante o streaming da etapa anterior
+            docs = await retrieval
+            retrieved_context = _join_with_budget((d.page_content for d, _ in docs), CONTEXT_MAX_CHARS)
             
-            CRITICAL INSTRUCTIONS:
-            1. You MUST replace AT LEAST 1-2 [MISSING: ...] markers with concrete information
-            2. ACTUALLY REPLACE the text '[MISSING: xyz]' with real content - don't keep the marker
-            3. Use the information above to guide what content to add
-            4. Do NOT add any new [MISSING:] markers - only fill or keep existing ones
-            5. If you cannot fill a gap with certainty, keep it as [MISSING: ...]
-            
-            Important: This is iteration {iteration}. You MUST make progress by filling gaps.
-            
-            Rewrite the ENTIRE answer with the [MISSING:] markers replaced:"""
-            
-            current_draft = self._generate_text(fill_prompt, {
+            # Refinamento (Fill Gaps) e novas consultas na mesma chamada
+            result = await self._agenerate_draft_step('iter_fill', {
                 "query": query, 
                 "draft": current_draft, 
                 "context": retrieved_context,
                 "iteration": i+1
-            })
-            self.verbose_print(f"Draft Refinado ({i+1}):\n{current_draft[:200]}...")
+            }, retrieve=retrieve if i == 0 else None)
+            gaps_before = len(_missing_topics(current_draft))
+            current_draft, retrieval = result["refined_draft"], result["retrieval"]
+            gaps_after = len(_missing_topics(current_draft))
+            self.verbose_print("Draft Refinado (%d):\n%.200s...", i + 1, current_draft)
+            if gaps_before and gaps_after >= gaps_before:
+                self.verbose_print("Nenhuma lacuna preenchida nesta iteração (%d restantes).", gaps_after)
 
         # 3. Fase de Expansão (Expansion Phase) - v1.3.0
-        # Analisa o rascunho final para ver se pode ser enriquecido
+        # Uma única chamada marca lacunas mais profundas e já devolve as consultas para preenchê-las
         self.verbose_print("--- Fase de Expansão ---")
-        expansion_prompt = """Review this draft answer:
-        {draft}
-        
-        Identify areas that could benefit from MORE specific information.
-        Add new [MISSING: ...] markers for:
-        - Technical details that were glossed over
-        - Specific examples that would clarify concepts
-        - Comparative data that would add context
-        - Implementation specifics that developers would need
-        
-        Return the same text but with ADDITIONAL [MISSING: ...] markers for deeper details.
-        If the answer is already comprehensive, do not add any markers."""
-        
-        expanded_draft = self._generate_text(expansion_prompt, {"draft": current_draft})
-        new_gaps_count = expanded_draft.count("[MISSING:")
+        result = await self._agenerate_draft_step('iter_expand', {"draft": current_draft})
+        expanded_draft, gap_queries = result["refined_draft"], result["gap_queries"]
+        # Conta apenas os marcadores novos, ignorando lacunas que já estavam no rascunho
+        new_gaps_count = len(set(_missing_topics(expanded_draft)) - set(_missing_topics(current_draft)))
         
         if new_gaps_count > 0:
-            self.verbose_print(f"Expansão identificou {new_gaps_count} novas lacunas. Iniciando iteração extra...")
-            current_draft = expanded_draft
-            
-            # --- Iteração Extra (Expansão) ---
-            query_prompt_exp = """You received the following draft with gaps:
-            {draft}
-            
-            For each [MISSING: ...] marker, provide information to fill that gap.
-            List information for each gap."""
-            
-            gap_info = self._generate_text(query_prompt_exp, {"draft": current_draft})
-            
-            search_query_text = f"{query} {gap_info}"
-            docs = self.db.similarity_search_with_score(search_query_text, k=k)
-            retrieved_context = "\n\n".join([d.page_content for d, _ in docs])
-            
-            fill_prompt_exp = """Original question: {query}
-            Current draft:
-            {draft}
-            Information to help fill the gaps:
-            {context}
-            
-            Rewrite the ENTIRE answer with the [MISSING:] markers replaced with detailed information."""
-            
-            current_draft = self._generate_text(fill_prompt_exp, {
-                "query": query, 
-                "draft": current_draft, 
-                "context": retrieved_context
-            })
-            self.verbose_print(f"Draft Final Expandido:\n{current_draft[:200]}...")
-            
-            # Atualiza a query de busca final com o texto expandido
-            search_query_text = f"{query} {current_draft}"
+            self.verbose_print("Expansão identificou %d novas lacunas. Incluindo as consultas na busca final...", new_gaps_count)
+            # As consultas das novas lacunas direcionam a busca final para os detalhes faltantes
+            search_query_text = _search_text(query, current_draft, *gap_queries)
         else:
             self.verbose_print("Nenhuma expansão necessária. O rascunho já está completo.")
-            search_query_text = f"{query} {current_draft}"
+            search_query_text = _search_text(query, current_draft)
 
         return search_query_text
 
-    def search_documents(self, query: str, k: int = 10, strategy: str = 'default'):
+    async def _abuild_search_text(self, query: str, k: int, strategy: str, ef_search: int | None = None) -> str:
+        """Gera o texto que será usado na busca por similaridade, conforme a estratégia."""
+        if strategy == 'hyde':
+            return await self._agenerate_hyde_doc(query)
+        elif strategy == 'query2doc':
+            return await self._agenerate_query2doc_expansion(query)
+        elif strategy == 'iter-retgen':
+            return await self._agenerate_iter_retgen_context(query, k, ef_search)
+        return query
+
+    async def asearch_documents(self, query: str, k: int = 10, strategy: str = 'default', ef_search: int | None = None):
         """
         Realiza uma busca por similaridade no banco de vetores.
-        Strategies: 'default', 'hyde', 'query2doc', 'best'
+        Strategies: 'default', 'hyde', 'query2doc', 'iter-retgen', 'best'
         """
+        # Valida antes de gerar textos com o LLM, que seriam descartados pelo erro na consulta
+        _check_ef_search(ef_search)
         if strategy == 'best':
-            self.verbose_print("Calculando a melhor estratégia...")
-            strategies = ['default', 'hyde', 'query2doc', 'iter-retgen']
-            best_strategy = None
-            best_avg_score = float('inf') # Menor é melhor (distância)
-            best_results = []
-            
-            # Salva o print original para usar nos logs de resumo
-            original_v_print = self.verbose_print
-            def no_op(*args, **kwargs): pass
-
-            for s in strategies:
-                original_v_print(f"--- Testando estratégia: {s} ---")
-                
-                # Silencia os logs internos da chamada recursiva
-                self.verbose_print = no_op
-                try:
-                    results = self.search_documents(query, k, strategy=s)
-                finally:
-                    # Restaura o print original
-                    self.verbose_print = original_v_print
-                
-                if not results:
-                    avg_score = float('inf')
-                else:
-                    # Calcula a média dos scores (distância)
-                    avg_score = sum(score for _, score in results) / len(results)
-                
-                original_v_print(f"Estratégia '{s}' - Média de Score (Distância): {avg_score:.4f}")
-                
-                if avg_score < best_avg_score:
-                    best_avg_score = avg_score
-                    best_strategy = s
-                    best_results = results
-            
-            self.verbose_print(f"*** Estratégia Vencedora: {best_strategy} (Score: {best_avg_score:.4f}) ***")
-            return best_results
+            return await self._asearch_best(query, k, ef_search)
 
-        text_to_search = query
-        
-        if strategy == 'hyde':
-            text_to_search = self._generate_hyde_doc(query)
-        elif strategy == 'query2doc':
-            text_to_search = self._generate_query2doc_expansion(query)
-        elif strategy == 'iter-retgen':
-            text_to_search = self._generate_iter_retgen_context(query, k)
-            
-        self.verbose_print(f"Buscando por: '{text_to_search[:100]}...' (Strategy: {strategy})")
-        
-        # Nota: similarity_search_with_score aceita a string query e gera o embedding internamente
-        similar_docs = self.db.similarity_search_with_score(text_to_search, k=k)
+        stored = await self._aload_expansion_vectors(query, [strategy])
+        if strategy in stored:
+            self.verbose_print("Vetor da estratégia '%s' recuperado do banco.", strategy)
+            vector = stored[strategy]
+        else:
+            text_to_search = await self._abuild_search_text(query, k, strategy, ef_search)
+            self.verbose_print("Buscando por: '%.100s...' (Strategy: %s)", text_to_search, strategy)
+            # O embedding é obtido via cache, evitando chamadas repetidas à API para o mesmo texto
+            vector = await self._acached_embed(text_to_search)
+            await self._asave_expansion_vectors(query, {strategy: vector})
+
+        similar_docs = await self._asearch_by_vector(vector, k, ef_search)
         
-        self.verbose_print(f"Encontrados {len(similar_docs)} documentos similares.")
+        self.verbose_print("Encontrados %d documentos similares.", len(similar_docs))
         return similar_docs
 
-# Carrega as variáveis de ambiente do arquivo .env no escopo global
-load_dotenv()
+    async def _ascore_strategies(self, query: str, k: int, strategies, pool: "CandidatePool", probe_k: int, ef_search: int | None = None) -> list:
+        """
+        Gera os textos das estratégias em paralelo e retorna, para cada uma, (estratégia, vetor,
+        distância média) ou (estratégia, exceção, None) se a geração falhar. A distância é medida
+        localmente contra o conjunto de candidatos `pool`, sem novas consultas ao banco.
+        Vetores persistidos (`expansion_store`) são usados sem gerar o texto da estratégia.
+        """
+        # Estratégias com vetor persistido dispensam a geração do texto e o embedding
+        vectors = await self._aload_expansion_vectors(query, strategies)
+        pending = [s for s in strategies if s not in vectors]
+
+        if {'hyde', 'query2doc'} <= set(pending):
+            try:
+                await self._aprefetch_expansions(query)
+            except Exception as e:
+                # Sem a chamada combinada, cada estratégia gera o próprio texto
+                self.verbose_print(f"Geração combinada de HyDE e Query2Doc falhou: {e}")
+
+        # A geração dos textos é independente e limitada por I/O (LLM), então roda em paralelo.
+        # Os logs internos das tarefas ficam silenciados: elas herdam o contexto em que são criadas.
+        token = _SILENT.set(True)
+        try:
+            tasks = [self._abuild_search_text(query, k, s, ef_search) for s in pending]
+            texts = await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            _SILENT.reset(token)
+
+        results = []
+        candidates = []
+        for s, text in zip(pending, texts):
+            if isinstance(text, Exception):
+                self.verbose_print(f"Estratégia '{s}' falhou: {text}")
+                results.append((s, text, None))
+            else:
+                candidates.append((s, text))
+
+        if candidates:
+            # Um único lote de embeddings para todos os textos candidatos
+            embedded = await self._acached_embed_many([text for _, text in candidates])
+            new_vectors = {s: vector for (s, _), vector in zip(candidates, embedded)}
+            await self._asave_expansion_vectors(query, new_vectors)
+            vectors.update(new_vectors)
+
+        for s in strategies:
+            if s not in vectors:
+                continue
+            vector = vectors[s]
+            stats = pool.distance_stats(vector, probe_k)
+            if stats is None:
+                avg_score = float('inf')
+                self.verbose_print("Estratégia '%s' - Nenhum documento encontrado.", s)
+            else:
+                avg_score, min_score, median_score = stats
+                self.verbose_print("Estratégia '%s' - Média de Score (Distância): %.4f (Mín: %.4f, Mediana: %.4f)", s, avg_score, min_score, median_score)
+            results.append((s, vector, avg_score))
+        return results
+
+    async def _asearch_best(self, query: str, k: int, ef_search: int | None = None):
+        """
+        Executa as estratégias, das mais baratas às mais caras, e retorna os resultados da que obtiver
+        a menor distância média. Para assim que uma estratégia fica abaixo de `early_exit_threshold`.
+        A comparação usa os `BEST_PROBE_K` candidatos mais próximos de cada estratégia dentro de um
+        único conjunto amplo buscado com a query original; somente uma vencedora diferente da
+        busca padrão faz uma segunda consulta ao banco.
+        """
+        self.verbose_print("Calculando a melhor estratégia...")
+        # Estratégias pontuadas com sucesso e suas distâncias médias (menor é melhor)
+        strategies, vectors, avg_scores = [], [], []
+        first_error = None
+        probe_k = min(k, BEST_PROBE_K)
+
+        # Seletor barato: um só conjunto de candidatos, vizinho da query, serve para pontuar todas as
+        # estratégias. Favorece levemente a 'default', pois as demais só são medidas contra ele.
+        query_vector = await self._acached_embed(query)
+        pool = await self._afetch_candidate_pool(query_vector, k * CANDIDATE_POOL_FACTOR, ef_search)
+
+        for tier in BEST_STRATEGY_TIERS:
+            for s, vector, avg_score in await self._ascore_strategies(query, k, tier, pool, probe_k, ef_search):
+                if avg_score is None:
+                    first_error = first_error or vector
+                else:
+                    strategies.append(s)
+                    vectors.append(vector)
+                    avg_scores.append(avg_score)
+            if avg_scores and min(avg_scores) < self.early_exit_threshold:
+                self.verbose_print("Score abaixo de %.4f; estratégias restantes ignoradas.", self.early_exit_threshold)
+                break
+
+        if not strategies:
+            # Todas as estratégias falharam: propaga o primeiro erro
+            raise first_error
+
+        # Em caso de empate, vence a estratégia mais barata (a primeira pontuada)
+        best = int(np.argmin(avg_scores))
+        best_strategy, best_vector, best_avg_score = strategies[best], vectors[best], avg_scores[best]
+
+        self.verbose_print("*** Estratégia Vencedora: %s (Score: %.4f) ***", best_strategy, best_avg_score)
+        if best_strategy == 'default':
+            # O conjunto de candidatos já é o resultado da busca padrão
+            return pool.rerank(best_vector, k)
+        # Apenas uma vencedora alternativa busca o conjunto completo de documentos (embedding já em mãos)
+        return await self._asearch_by_vector(best_vector, k, ef_search)
+
+    def search_documents(self, query: str, k: int = 10, strategy: str = 'default', ef_search: int | None = None):
+        """
+        Versão síncrona de `asearch_documents`, usada pelo chat e pelos scripts de linha de comando.
+
+        Não pode ser chamada de dentro de um loop asyncio em execução: nesse caso, use
+        `await asearch_documents(...)`.
+        """
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            pass
+        else:
+            raise RuntimeError("search_documents não pode ser usada dentro de um loop asyncio; use asearch_documents.")
+        # Reutiliza o mesmo loop entre chamadas: os clientes assíncronos dos SDKs de LLM
+        # mantêm conexões presas ao loop em que foram criadas.
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+        return self._loop.run_until_complete(self.asearch_documents(query, k, strategy, ef_search))
+
+    def close(self):
+        """Encerra o loop de eventos usado por `search_documents`, se criado."""
+        if self._loop is not None:
+            self._loop.run_until_complete(self._loop.shutdown_asyncgens())
+            self._loop.close()
+            self._loop = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
 if __name__ == '__main__':
     import argparse
 
+    # Carrega as variáveis de ambiente do arquivo .env; quem importa o módulo como biblioteca
+    # (ex.: src.chat) é responsável por carregá-las
+    load_dotenv()
+
     parser = argparse.ArgumentParser(description="Busca documentos em um banco de dados vetorial.")
     parser.add_argument(
         "--provider",
@@ -310,13 +963,19 @@ if __name__ == '__main__':
         default="documentos_pdf", 
         help="O nome da coleção no banco de dados vetorial (padrão: documentos_pdf)."
     )
+    parser.add_argument(
+        "--ef-search",
+        type=int,
+        default=None,
+        help="Valor de hnsw.ef_search na busca (padrão: definido pelo número de embeddings no banco)."
+    )
     args = parser.parse_args()
 
     # Este teste assume que o 'ingest' foi executado com o provedor 'google'
     print(f"--- Teste da classe de busca (provedor: {args.provider}, coleção: {args.collection}) ---")
     try:
-        searcher = DocumentSearcher(provider=args.provider, collection_name=args.collection, verbose=args.verbose)
-        results = searcher.search_documents(args.query, strategy=args.strategy)
+        with DocumentSearcher(provider=args.provider, collection_name=args.collection, verbose=args.verbose) as searcher:
+            results = searcher.search_documents(args.query, strategy=args.strategy, ef_search=args.ef_search)
         
         if results:
             for doc, score in results:
@@ -1,40 +1,105 @@
 import os
+import time
+import pickle
+import sqlite3
+import hashlib
+from collections import OrderedDict
+from functools import lru_cache
 from langchain_google_genai import GoogleGenerativeAIEmbeddings, ChatGoogleGenerativeAI
 from langchain_openai import OpenAIEmbeddings, ChatOpenAI
 
-def get_connection_string() -> str:
-    """Constrói a string de conexão a partir das variáveis de ambiente."""
-    user = os.getenv("POSTGRES_USER")
-    password = os.getenv("POSTGRES_PASSWORD")
-    host = os.getenv("POSTGRES_HOST")
-    port = os.getenv("POSTGRES_PORT")
-    db = os.getenv("POSTGRES_DB")
-    return f"postgresql+psycopg://{user}:{password}@{host}:{port}/{db}"
+DB_VARS = ("POSTGRES_USER", "POSTGRES_PASSWORD", "POSTGRES_HOST", "POSTGRES_PORT", "POSTGRES_DB")
+ENV_VARS = (*DB_VARS, "GOOGLE_API_KEY", "OPENAI_API_KEY", "EMBEDDINGS_PROVIDER", "SEARCH_CACHE_PATH",
+            "PERSIST_EXPANSION_VECTORS", "BEST_EARLY_EXIT")
+
+# Modelo de embeddings local (ONNX Runtime, via fastembed), sem chamadas de rede
+LOCAL_ONNX_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+
+@lru_cache(maxsize=1)
+def _env() -> dict:
+    """
+    Retrato das variáveis de ambiente usadas pelo projeto, lido no primeiro acesso
+    (depois do `load_dotenv()` dos scripts). Use `reload_env` para relê-las.
+    """
+    return {var: os.getenv(var) for var in ENV_VARS}
+
+def reload_env():
+    """Descarta o retrato das variáveis de ambiente; o próximo acesso as lê novamente."""
+    _env.cache_clear()
+
+def get_env(var: str, default: str | None = None) -> str | None:
+    """Valor da variável `var` (uma das `ENV_VARS`) no retrato do ambiente, ou `default` se vazia."""
+    return _env()[var] or default
+
+def get_connection_string(scheme: str = "postgresql+psycopg") -> str:
+    """
+    Constrói a string de conexão a partir das variáveis de ambiente.
+    O esquema padrão é o do SQLAlchemy; use "postgresql" para conectar diretamente com o psycopg.
+    """
+    env = _env()
+    user, password, host, port, db = (env[var] for var in DB_VARS)
+    return f"{scheme}://{user}:{password}@{host}:{port}/{db}"
+
+def get_pgvector_version(conn) -> tuple[int, ...]:
+    """Retorna a versão da extensão pgvector instalada no banco (tupla vazia se ausente)."""
+    row = conn.execute("SELECT extversion FROM pg_extension WHERE extname = 'vector'").fetchone()
+    return tuple(int(part) for part in row[0].split(".")) if row else ()
+
+# Parâmetros HNSW pelo número de embeddings indexados: (limite de linhas, m, ef_construction, ef_search)
+HNSW_PARAM_LADDER = (
+    (100_000, 16, 64, 40),
+    (1_000_000, 24, 128, 100),
+    (None, 32, 200, 200),
+)
+
+def hnsw_params(row_count: int) -> dict:
+    """Escolhe m, ef_construction e ef_search do HNSW conforme o número de embeddings."""
+    for limit, m, ef_construction, ef_search in HNSW_PARAM_LADDER:
+        if limit is None or row_count < limit:
+            return {"m": m, "ef_construction": ef_construction, "ef_search": ef_search}
 
 def check_env_vars(provider: str):
     """Verifica se as variáveis de ambiente necessárias estão definidas."""
-    db_vars = ["POSTGRES_USER", "POSTGRES_PASSWORD", "POSTGRES_HOST", "POSTGRES_PORT", "POSTGRES_DB"]
-    if not all(os.getenv(var) for var in db_vars):
-        missing = [var for var in db_vars if not os.getenv(var)]
+    env = _env()
+    missing = [var for var in DB_VARS if not env[var]]
+    if missing:
         raise EnvironmentError(f"Variáveis de banco de dados ausentes: {', '.join(missing)}")
 
-    if provider == 'google' and not os.getenv("GOOGLE_API_KEY"):
+    if provider == 'google' and not env["GOOGLE_API_KEY"]:
         raise EnvironmentError("Para o provedor 'google', a GOOGLE_API_KEY é necessária.")
-    elif provider == 'openai' and not os.getenv("OPENAI_API_KEY"):
+    elif provider == 'openai' and not env["OPENAI_API_KEY"]:
         raise EnvironmentError("Para o provedor 'openai', a OPENAI_API_KEY é necessária.")
 
+def embeddings_provider(provider: str) -> str:
+    """Provedor efetivo dos embeddings: EMBEDDINGS_PROVIDER, se definido, ou o mesmo do LLM."""
+    return _env()["EMBEDDINGS_PROVIDER"] or provider
+
+@lru_cache(maxsize=1)
+def _local_onnx_embeddings():
+    """Carrega o modelo local uma única vez por processo (a sessão ONNX é cara de criar)."""
+    # Dependência opcional: pip install fastembed
+    from langchain_community.embeddings import FastEmbedEmbeddings
+    return FastEmbedEmbeddings(model_name=LOCAL_ONNX_MODEL)
+
 def get_embeddings_model(provider: str, verbose: bool = False):
-    """Retorna a instância do modelo de embeddings com base no provedor."""
+    """
+    Retorna a instância do modelo de embeddings com base no provedor.
+    A variável EMBEDDINGS_PROVIDER pode trocá-lo (ex.: 'local-onnx') sem mudar o provedor do LLM.
+    """
     verbose_print = v_print(verbose)
+    provider = embeddings_provider(provider)
     
-    if provider == 'google':
+    if provider == 'local-onnx':
+        verbose_print(f"Usando o modelo de embeddings local ({LOCAL_ONNX_MODEL}, ONNX Runtime).")
+        return _local_onnx_embeddings()
+    elif provider == 'google':
         verbose_print("Usando o modelo de embeddings do Google (models/embedding-001).")
         return GoogleGenerativeAIEmbeddings(model="models/embedding-001")
     elif provider == 'openai':
         verbose_print("Usando o modelo de embeddings da OpenAI (text-embedding-3-small).")
         return OpenAIEmbeddings(model="text-embedding-3-small")
     else:
-        raise ValueError("Provedor inválido. Escolha 'google' ou 'openai'.")
+        raise ValueError("Provedor de embeddings inválido. Escolha 'google', 'openai' ou 'local-onnx'.")
 
 def get_chat_model(provider: str, verbose: bool = False):
     """Retorna a instância do modelo de chat com base no provedor."""
@@ -49,9 +114,96 @@ def get_chat_model(provider: str, verbose: bool = False):
     else:
         raise ValueError("Provedor inválido. Escolha 'google' ou 'openai'.")
 
+def no_op(*args, **kwargs):
+    """Função de print que não imprime nada (usada quando verbose é False)."""
+
 def v_print(verbose: bool):
     """Retorna uma função de print que só imprime se verbose for True."""
+    if not verbose:
+        return no_op
     def print_if_verbose(*args, **kwargs):
         if verbose:
             print(*args, **kwargs)
     return print_if_verbose
+
+def hash_key(*parts: str) -> str:
+    """Gera uma chave SHA-256 estável a partir das partes informadas."""
+    return hashlib.sha256("|".join(parts).encode("utf-8")).hexdigest()
+
+class LRUCache:
+    """
+    Cache em memória com política LRU e expiração opcional (TTL) por entrada.
+    Se `backing` for definido (ex.: `SqliteCache`), as falhas em memória são consultadas
+    nele e as escritas também são persistidas.
+    """
+    def __init__(self, maxsize: int = 1024, ttl: float | None = None, backing=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.backing = backing
+        self._data = OrderedDict()
+
+    def get(self, key: str):
+        """Retorna o valor associado à chave, ou None se ausente ou expirado."""
+        entry = self._data.get(key)
+        if entry is not None:
+            value, stored_at = entry
+            if self.ttl is None or time.monotonic() - stored_at <= self.ttl:
+                self._data.move_to_end(key)
+                return value
+            del self._data[key]
+        if self.backing is None:
+            return None
+        entry = self.backing.get_entry(key)
+        if entry is None:
+            return None
+        # Mantém a idade original, para que a entrada expire na memória junto com a persistida
+        value, age = entry
+        self._remember(key, value, age)
+        return value
+
+    def put(self, key: str, value):
+        """Armazena o valor, descartando a entrada menos usada se o cache estiver cheio."""
+        self._remember(key, value)
+        if self.backing is not None:
+            self.backing.put(key, value)
+
+    def _remember(self, key: str, value, age: float = 0.0):
+        """Guarda o valor apenas na memória, como se tivesse sido armazenado há `age` segundos."""
+        self._data[key] = (value, time.monotonic() - age)
+        self._data.move_to_end(key)
+        if len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+class SqliteCache:
+    """
+    Cache persistente em SQLite (valores serializados com pickle), compartilhado entre execuções.
+    Usado como camada de apoio de um `LRUCache`, com o mesmo `ttl`; cada cache usa a sua `table`.
+    As entradas expiradas são removidas ao abrir o arquivo.
+    """
+    def __init__(self, path: str, table: str = "cache", ttl: float | None = None):
+        self.ttl = ttl
+        self.table = table
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(f"CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, value BLOB, stored_at REAL)")
+        if ttl is not None:
+            self._conn.execute(f"DELETE FROM {table} WHERE stored_at < ?", (time.time() - ttl,))
+
+    def get_entry(self, key: str) -> tuple | None:
+        """Retorna (valor, idade em segundos) da chave, ou None se ausente ou expirado."""
+        row = self._conn.execute(f"SELECT value, stored_at FROM {self.table} WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        value, stored_at = row
+        age = max(time.time() - stored_at, 0.0)
+        if self.ttl is not None and age > self.ttl:
+            self._conn.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+            return None
+        return pickle.loads(value), age
+
+    def put(self, key: str, value):
+        """Armazena (ou substitui) o valor da chave."""
+        self._conn.execute(
+            f"INSERT OR REPLACE INTO {self.table} (key, value, stored_at) VALUES (?, ?, ?)",
+            (key, pickle.dumps(value), time.time()),
+        )